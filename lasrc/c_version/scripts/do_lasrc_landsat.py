@@ -1,14 +1,151 @@
 #! /usr/bin/env python
 import sys
 import os
+import stat
 import re
-import commands
+import subprocess
 import datetime
+import multiprocessing
 from optparse import OptionParser
 import logging
 
 ERROR = 1
 SUCCESS = 0
+LASRC_VERSION = None     # cached output of lasrc --version
+
+# Landsat-8 collection XML filename; the acquisition date (YYYYMMDD) is the
+# 4th group, separated by underscores
+L8_XML_DATE_RE = re.compile(
+    r'^(?:LC08|LO08)_[^_]+_[^_]+_(\d{4})(\d{2})(\d{2})_')
+
+
+############################################################################
+# Description: execute_cmd runs the specified command directly, without an
+# intermediate shell, and captures its combined stdout/stderr output.
+#
+# Inputs:
+#   argv - list containing the executable followed by its arguments
+#   cwd - directory in which to run the command (default is the current
+#         working directory)
+#
+# Returns:
+#   (status, output) - exit code of the command (negative if terminated by
+#                      a signal) and the combined stdout/stderr, without
+#                      the trailing newline
+#
+# Notes:
+#   1. os.posix_spawnp is not used to launch the command.  It has no
+#      working-directory file action, so it could not start the applications
+#      in the XML directory without changing the directory of this whole
+#      process.  On Python 3.10+ on Linux, subprocess already launches the
+#      command with vfork.
+############################################################################
+def execute_cmd (argv, cwd=None):
+    try:
+        proc = subprocess.Popen (argv, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT, universal_newlines=True, cwd=cwd)
+    except OSError as e:
+        return (ERROR, '{}: {}'.format(argv[0], e.strerror))
+    output = proc.communicate()[0]
+    return (proc.returncode, output.rstrip('\n'))
+
+
+############################################################################
+# Description: stream_cmd runs the specified command directly, without an
+# intermediate shell, and passes each line of its combined stdout/stderr to
+# the logger as it is produced.
+#
+# Inputs:
+#   argv - list containing the executable followed by its arguments
+#   logger - logger to receive the output lines as info messages
+#   cwd - directory in which to run the command (default is the current
+#         working directory)
+#
+# Returns:
+#   status - exit code of the command (negative if terminated by a signal)
+#
+# Notes:
+#   1. Unlike execute_cmd, the output is never held in memory as a whole.
+#      This is meant for long running, verbose applications.
+############################################################################
+def stream_cmd (argv, logger, cwd=None):
+    try:
+        proc = subprocess.Popen (argv, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT, bufsize=1, universal_newlines=True,
+            cwd=cwd)
+    except OSError as e:
+        logger.error ('%s: %s', argv[0], e.strerror)
+        return ERROR
+
+    # readline rather than file iteration, which reads ahead on Python 2
+    for line in iter(proc.stdout.readline, ''):
+        logger.info ('%s', line.rstrip())
+    proc.stdout.close()
+    return proc.wait()
+
+
+############################################################################
+# Description: lasrc_version returns the version string reported by
+# lasrc --version.  The application is only run the first time; the result
+# is cached for subsequent calls within this process.
+#
+# Returns:
+#   version - version string of the lasrc application
+############################################################################
+def lasrc_version ():
+    global LASRC_VERSION
+    if LASRC_VERSION is None:
+        (status, output) = execute_cmd (['lasrc', '--version'])
+        LASRC_VERSION = output.strip()
+    return LASRC_VERSION
+
+
+############################################################################
+# Description: prefetch_file asks the kernel to start reading the specified
+# file into the page cache, so a later read by another process does not
+# have to wait on the disk.
+#
+# Inputs:
+#   path - name of the file to prefetch
+#
+# Returns: nothing
+#
+# Notes:
+#   1. This is only a hint.  It is silently skipped if posix_fadvise is not
+#      available (Python 3.3+ on POSIX systems) or the file can't be opened.
+############################################################################
+def prefetch_file (path):
+    if not hasattr(os, 'posix_fadvise'):
+        return
+
+    try:
+        fd = os.open (path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.posix_fadvise (fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    except OSError:
+        pass
+    finally:
+        os.close (fd)
+
+
+############################################################################
+# Description: run_scene is the per-scene worker for
+# SurfaceReflectance.runBatch.  It lives at module level so it can be
+# pickled and handed to the worker processes.
+#
+# Inputs:
+#   args - tuple of (cls, xml_infile, process_sr, write_toa) for the scene,
+#       where cls is the SurfaceReflectance class (or subclass) runBatch was
+#       called on
+#
+# Returns:
+#   status - ERROR or SUCCESS as returned by runSr
+############################################################################
+def run_scene (args):
+    (cls, xml_infile, process_sr, write_toa) = args
+    return cls().runSr (xml_infile, process_sr, write_toa)
 
 
 #############################################################################
@@ -46,11 +183,12 @@ class SurfaceReflectance():
     #     SUCCESS - successful processing
     #
     # Notes:
-    #   1. The script obtains the path of the XML file and changes
-    #      directory to that path for running the surface reflectance
-    #      application.  If the XML file directory is not writable, then this
-    #      script exits with an error.
-    #   2. If the XML file is not specified and the information is
+    #   1. The script obtains the path of the XML file and runs the surface
+    #      reflectance applications from that directory.  If the XML file
+    #      directory is not writable, then this script exits with an error.
+    #   2. The current working directory of this process is not changed, so
+    #      runSr may be called from several threads at once.
+    #   3. If the XML file is not specified and the information is
     #      going to be grabbed from the command line, then it's assumed all
     #      the parameters will be pulled from the command line.
     #######################################################################
@@ -59,8 +197,7 @@ class SurfaceReflectance():
         # command line
         if xml_infile == None:
             # Get version number
-            cmdstr = ('lasrc --version')
-            (status, self.version) = commands.getstatusoutput(cmdstr)
+            self.version = lasrc_version()
 
             # get the command line argument for the XML file
             parser = OptionParser(version = self.version)
@@ -90,116 +227,140 @@ class SurfaceReflectance():
 
         # get the logger
         logger = logging.getLogger(__name__)
-        msg = ('Surface reflectance processing of Landsat-8 file: {}'
-               .format(xml_infile))
-        logger.info (msg)
+        logger.info ('Surface reflectance processing of Landsat-8 file: %s',
+                     xml_infile)
         
-        # make sure the XML file exists
-        if not os.path.isfile(xml_infile):
-            msg = ('XML file does not exist or is not accessible: {}'
-                   .format(xml_infile))
-            logger.error (msg)
+        # make sure the XML file exists (a single stat of the file)
+        try:
+            st = os.stat (xml_infile)
+        except OSError:
+            st = None
+        if st is None or not stat.S_ISREG(st.st_mode):
+            logger.error ('XML file does not exist or is not accessible: %s',
+                          xml_infile)
             return ERROR
 
-        # use the base XML filename and not the full path.
-        base_xmlfile = os.path.basename (xml_infile)
-        msg = 'Processing XML file: {}'.format(base_xmlfile)
-        logger.info (msg)
-        
-        # get the path of the XML file and change directory to that location
-        # for running this script.  save the current working directory for
-        # return to upon error or when processing is complete.  Note: use
-        # abspath to handle the case when the filepath is just the filename
-        # and doesn't really include a file path (i.e. the current working
-        # directory).
-        mydir = os.getcwd()
-        xmldir = os.path.dirname (os.path.abspath (xml_infile))
+        # get the path of the XML file and use the base XML filename and not
+        # the full path.  the applications are run from the XML directory.
+        # Note: use abspath to handle the case when the filepath is just the
+        # filename and doesn't really include a file path (i.e. the current
+        # working directory).
+        (xmldir, base_xmlfile) = os.path.split (os.path.abspath (xml_infile))
+        logger.info ('Processing XML file: %s', base_xmlfile)
+
         if not os.access(xmldir, os.W_OK):
-            msg = ('Path of XML file is not writable: {}. Script needs '
-                   'write access to the XML directory.'.format(xmldir))
-            logger.error (msg)
+            logger.error ('Path of XML file is not writable: %s. Script needs '
+                          'write access to the XML directory.', xmldir)
             return ERROR
-        msg = ('Changing directories for surface reflectance processing: {}'
-               .format(xmldir))
-        logger.info (msg)
-        os.chdir (xmldir)
+        logger.info ('Running surface reflectance processing in: %s', xmldir)
 
         # pull the date from the XML filename to determine which auxiliary
         # file should be used for input.
         # Example: LC08_L1TP_041027_20130630_20140312_01_T1.xml uses the
         # L8ANC2013181.hdf_fused HDF file.
-        l8_prefixes_collection = ['LC08', 'LO08']
-        if base_xmlfile[0:4] in l8_prefixes_collection:
+        match = L8_XML_DATE_RE.match(base_xmlfile)
+        if match:
             # Collection naming convention. Pull the year, month, day from the
-            # XML filename. It should be the 4th group, separated by
-            # underscores. Then convert month, day to DOY.
-            aux_date = base_xmlfile.split('_')[3]
-            aux_year = aux_date[0:4]
-            aux_month = aux_date[4:6]
-            aux_day = aux_date[6:8]
-            myday = datetime.date(int(aux_year), int(aux_month), int(aux_day))
-            aux_doy = myday.strftime("%j")
-            aux_file = 'L8ANC{}{}.hdf_fused'.format(aux_year, aux_doy)
+            # XML filename, then convert month, day to DOY.
+            (aux_year, aux_month, aux_day) = [int(x) for x in match.groups()]
+            aux_doy = (datetime.date(aux_year, aux_month, aux_day).toordinal()
+                       - datetime.date(aux_year, 1, 1).toordinal() + 1)
+            aux_file = 'L8ANC{}{:03d}.hdf_fused'.format(aux_year, aux_doy)
         else:
-            msg = ('Base XML filename is not recognized as a valid Landsat-8 '
-                   'scene name'.format(base_xmlfile))
-            logger.error (msg)
-            os.chdir (mydir)
+            logger.error ('Base XML filename is not recognized as a valid '
+                          'Landsat-8 scene name: %s', base_xmlfile)
             return ERROR
 
+        # start reading the auxiliary file into the page cache so that disk
+        # I/O overlaps with the angle band processing below.  lasrc looks for
+        # it in $LASRC_AUX_DIR/LADS/<year>, using the local directory if
+        # LASRC_AUX_DIR isn't defined.  relative paths are resolved from the
+        # XML directory, where lasrc is run.
+        if process_sr != 'False':
+            aux_path = os.environ.get('LASRC_AUX_DIR', '.')
+            prefetch_file (os.path.join (xmldir, aux_path, 'LADS',
+                                         str(aux_year), aux_file))
+
         # generate per-pixel angle bands for band 4 (representative band)
-        cmdstr = 'create_l8_angle_bands --xml {}'.format(base_xmlfile)
-        logger.debug('per-pixel angles command: {0}'.format(cmdstr))
-        (status, output) = commands.getstatusoutput(cmdstr)
+        argv = ['create_l8_angle_bands', '--xml', base_xmlfile]
+        logger.debug('per-pixel angles command: %s', ' '.join(argv))
+        (status, output) = execute_cmd(argv, cwd=xmldir)
         logger.info(output)
-        exit_code = status >> 8
-        if exit_code != 0:
+        if status != 0:
             logger.error('Error running create_l8_angle_bands. Processing '
                          'will terminate.')
-            os.chdir(mydir)
             return ERROR
 
         # Mask the angle bands to match the band quality band
-        cmdstr = ('mask_per_pixel_angles.py --xml {}'
-                  .format(base_xmlfile))
-        (status, output) = commands.getstatusoutput(cmdstr)
+        argv = ['mask_per_pixel_angles.py', '--xml', base_xmlfile]
+        (status, output) = execute_cmd(argv, cwd=xmldir)
         logger.info(output)
-        exit_code = status >> 8
-        if exit_code != 0:
+        if status != 0:
             logger.error('Error masking angle bands with the band '
                          'quality band. Processing will terminate.')
             return ERROR
 
         # run surface reflectance algorithm, checking the return status.  exit
         # if any errors occur.
-        process_sr_opt_str = '--process_sr=true '
-        write_toa_opt_str = ''
-
+        argv = ['lasrc', '--xml={}'.format(base_xmlfile),
+                '--aux={}'.format(aux_file)]
         if process_sr == 'False':
-            process_sr_opt_str = '--process_sr=false '
+            argv.append('--process_sr=false')
+        else:
+            argv.append('--process_sr=true')
         if write_toa:
-            write_toa_opt_str = '--write_toa '
-
-        cmdstr = ('lasrc --xml={} --aux={} {}{}--verbose'
-                  .format(xml_infile, aux_file, process_sr_opt_str,
-                          write_toa_opt_str))
-        msg = 'Executing lasrc command: {}'.format(cmdstr)
-        logger.debug (msg)
-        (status, output) = commands.getstatusoutput (cmdstr)
-        logger.info (output)
-        exit_code = status >> 8
-        if exit_code != 0:
-            msg = 'Error running lasrc.  Processing will terminate.'
-            logger.error (msg)
-            os.chdir (mydir)
+            argv.append('--write_toa')
+        argv.append('--verbose')
+
+        logger.debug ('Executing lasrc command: %s', ' '.join(argv))
+        status = stream_cmd (argv, logger, cwd=xmldir)
+        if status != 0:
+            logger.error ('Error running lasrc.  Processing will terminate.')
             return ERROR
         
-        # successful completion.  return to the original directory.
-        os.chdir (mydir)
-        msg = 'Completion of surface reflectance.'
-        logger.info (msg)
+        # successful completion
+        logger.info ('Completion of surface reflectance.')
         return SUCCESS
 
+
+    ########################################################################
+    # Description: runBatch runs the surface reflectance processing for a
+    # list of scenes, processing several scenes at the same time in separate
+    # worker processes.
+    #
+    # Inputs:
+    #   xml_list - list of input XML files, one per scene
+    #   workers - number of scenes to process at the same time.  Default is
+    #       the number of CPUs.
+    #   process_sr - see runSr
+    #   write_toa - see runSr
+    #
+    # Returns:
+    #   statusList - ERROR or SUCCESS for each scene, in the same order as
+    #       xml_list
+    #
+    # Notes:
+    #   1. Each scene is processed in a worker process, and the workers are
+    #      handed one scene at a time, so a few long scenes don't hold up
+    #      the scenes queued behind them.
+    #######################################################################
+    @classmethod
+    def runBatch (cls, xml_list, workers=None, process_sr=None,
+                  write_toa=False):
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+
+        jobs = [(cls, xml_infile, process_sr, write_toa)
+                for xml_infile in xml_list]
+        pool = multiprocessing.Pool (workers)
+        try:
+            statusList = pool.map (run_scene, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+        return statusList
+
 ######end of SurfaceReflectance class######
 
 if __name__ == "__main__":
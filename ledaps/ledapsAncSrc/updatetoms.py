@@ -12,21 +12,62 @@
 ############################################################################
 import sys
 import os
-import fnmatch
+import shutil
 import datetime
-import commands
+import calendar
+import collections
+import email.utils
 import re
-import time
 import subprocess
 import logging
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 from optparse import OptionParser
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)  # Get logger for the module.
 
 # Global static variables
 ERROR = 1
 SUCCESS = 0
+UNCHANGED = 2          # file has not been modified since it was processed
 START_YEAR = 1978      # quarterly processing will reprocess back to the
                        # start of the TOMS data to make sure all data is
                        # up to date
+DOWNLOAD_THREADS = 16  # number of days of TOMS files to download at once
+DOWNLOAD_TRIES = 5     # number of attempts to download each TOMS file
+DOWNLOAD_TIMEOUT = (10, 30)  # seconds to wait for the server to accept the
+                             # connection and to send data
+
+# filename template of the daily ozone files for each instrument type; the
+# date (YYYYMMDD) gets filled in
+FILENAME_TEMPLATES = {'NIMBUS': 'L3_ozone_n7t_%s.txt',
+                      'EARTHPROBE': 'L3_ozone_epc_%s.txt',
+                      'METEOR3': 'L3_ozone_m3t_%s.txt',
+                      'OMI': 'L3_ozone_omi_%s.txt'}
+
+# regular expression to pull the date (YYYYMMDD) from the downloaded daily
+# ozone filenames
+DATE_REGEX = re.compile(r'_(\d{8})\.txt$')
+
+# instrument tags of the daily ozone files in order of priority: OMI,
+# EARTHPROBE, METEOR3, and NIMBUS7
+INSTRUMENT_PRIORITY = ('omi', 'epc', 'm3t', 'n7t')
+
+# HTTP session shared by all the downloads, so the connections to the TOMS
+# server are kept alive and reused.  Connection problems and server errors
+# are retried, up to DOWNLOAD_TRIES attempts, waiting 0, 2, 4 and 8 seconds
+# before the retries.  Retry-After headers are ignored, so the server can't
+# stretch those waits.  Along with DOWNLOAD_TIMEOUT, this bounds the time
+# spent on a file that can't be downloaded to a few minutes.
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(pool_connections=4,
+    pool_maxsize=DOWNLOAD_THREADS,
+    max_retries=Retry(total=DOWNLOAD_TRIES - 1, backoff_factor=1,
+                      status_forcelist=[500, 502, 503, 504],
+                      respect_retry_after_header=False)))
 
 ############################################################################
 # Datasource object to identify the instrument type and URL
@@ -40,6 +81,32 @@ class Datasource:
         self.url = url         # URL
 
 
+############################################################################
+# Description: dateStrings will build the date strings (YYYYMMDD) for the
+# first ndays days of the specified year.
+#
+# Inputs:
+#   year - year of the dates (integer)
+#   ndays - number of days, starting at January 1st (integer)
+#
+# Returns:
+#   dateList - list of date strings; element i is the date of DOY i+1
+#
+# Notes:
+#   A single date is stepped forward one day at a time and formatted
+#   directly, instead of constructing and strftime'ing a datetime per day.
+############################################################################
+def dateStrings (year, ndays):
+    dateList = []
+    currday = datetime.date(year, 1, 1)
+    oneday = datetime.timedelta(days=1)
+    for i in range(ndays):
+        dateList.append('%04d%02d%02d'
+                        % (currday.year, currday.month, currday.day))
+        currday += oneday
+    return dateList
+
+
 ############################################################################
 # DatasourceResolver class
 ############################################################################
@@ -52,6 +119,18 @@ class DatasourceResolver:
     EARTHPROBE = '/eptoms/data/ozone/Y'
     METEOR3 = '/meteor3/data/ozone/Y'
     OMI = '/omi/data/ozone/Y'
+
+    # Instrument(s) used for each range of years, as (first year, last year,
+    # primary instrument, backup instrument).  The backup instrument is used
+    # in the event the desired date does not exist for the primary
+    # instrument.  A last year of None means the instrument is used for all
+    # later years.  There is no TOMS ozone data for 1995.
+    YEAR_RANGES = ((1978, 1990, 'NIMBUS', None),
+                   (1991, 1993, 'METEOR3', 'NIMBUS'),
+                   (1994, 1994, 'METEOR3', None),
+                   (1996, 2003, 'EARTHPROBE', None),
+                   (2004, 2005, 'OMI', 'EARTHPROBE'),
+                   (2006, None, 'OMI', None))
     
     def __init__(self):
         pass
@@ -74,84 +153,35 @@ class DatasourceResolver:
     #         not exist on the primary URL.
     #
     # Notes:
+    #   The instruments for each year are specified in YEAR_RANGES.
     #######################################################################
     def resolve(self, year, DOY):
-        logger = logging.getLogger(__name__)  # Get logger for the module.
-        # use NIMBUS data for 1978-1990
-        if year in range(1978, 1991):
-            dsList = self.buildURL('NIMBUS', self.SERVER_URL, self.NIMBUS, year,
-                                   DOY)
-            if dsList is None:
-                logger.warn('Could not resolve NIMBUS datasource for year, '
-                            'DOY: {0}/{1}'.format(year, DOY))
-                return None
-
-        # use METEOR3 data for 1991-1993, with NIMBUS as the backup
-        elif year in range(1991, 1994):
-            dsList = self.buildURL('METEOR3', self.SERVER_URL, self.METEOR3,
-                                   year, DOY)
-            if dsList is None:
-                logger.warn('Could not resolve METEOR3 datasource for year, '
-                            'DOY: {0}/{1}'.format(year, DOY))
-                return None
-
-            dsList2 = self.buildURL('NIMBUS', self.SERVER_URL, self.NIMBUS,
-                                   year, DOY)
-            if dsList2 is None:
-                logger.warn('Could not resolve NIMBUS datasource for year, '
-                            'DOY: {0}/{1}'.format(year, DOY))
-            else:
-                dsList.extend(dsList2)
+        # find the primary and backup instruments for the specified year
+        for (first, last, primary, backup) in self.YEAR_RANGES:
+            if first <= year and (last is None or year <= last):
+                break
+        else:
+            # year requested does not have TOMS ozone data
+            logger.warn('Could not resolve a datasource for year, DOY: {0}/{1}'
+                        .format(year, DOY))
+            return None
 
+        dsList = self.buildURL(primary, self.SERVER_URL,
+                               getattr(self, primary), year, DOY)
+        if dsList is None:
+            logger.warn('Could not resolve {0} datasource for year, '
+                        'DOY: {1}/{2}'.format(primary, year, DOY))
+            return None
 
-        # use METEOR3 data for 1994
-        elif year == 1994:
-            dsList = self.buildURL('METEOR3', self.SERVER_URL, self.METEOR3,
-                                   year, DOY)
-            if dsList is None:
-                logger.warn('Could not resolve METEOR3 datasource for year, '
-                            'DOY: {0}/{1}'.format(year, DOY))
-                return None
-
-        # use EARTHPROBE data for 1996-2003
-        elif year in range(1996, 2004):
-            dsList = self.buildURL('EARTHPROBE', self.SERVER_URL,
-                                   self.EARTHPROBE, year, DOY)
-            if dsList is None:
-                logger.warn('Could not resolve EARTHPROBE datasource for year, '
-                            'DOY: {0}/{1}'.format(year, DOY))
-                return None
-
-        # use OMI data for 2004-2005, with EARTHPROBE as the backup
-        elif year in range(2004, 2006):
-            dsList = self.buildURL('OMI', self.SERVER_URL, self.OMI, year, DOY)
-            if dsList is None:
-                logger.warn('Could not resolve EARTHPROBE datasource for year, '
-                            'DOY: {0}/{1}'.format(year, DOY))
-                return None
-
-            dsList2 = self.buildURL('EARTHPROBE', self.SERVER_URL,
-                self.EARTHPROBE, year, DOY)
+        if backup is not None:
+            dsList2 = self.buildURL(backup, self.SERVER_URL,
+                                    getattr(self, backup), year, DOY)
             if dsList2 is None:
-                logger.warn('Could not resolve EARTHPROBE datasource for year, '
-                            'DOY: {0}/{1}'.format(year, DOY))
+                logger.warn('Could not resolve {0} datasource for year, '
+                            'DOY: {1}/{2}'.format(backup, year, DOY))
             else:
                 dsList.extend(dsList2)
 
-        # use OMI for any years beyond 2006
-        elif year >= 2006:
-            dsList = self.buildURL('OMI', self.SERVER_URL, self.OMI, year, DOY)
-            if dsList is None:
-                logger.warn('Could not resolve OMI datasource for year, DOY: '
-                            '{0}/{1}'.format(year, DOY))
-                return None
-
-        # year requested does not have TOMS ozone data
-        else:
-            logger.warn('Could not resolve a datasource for year, DOY: {0}/{1}'
-                        .format(year, DOY))
-            return None
-
         return dsList
 
 
@@ -175,32 +205,19 @@ class DatasourceResolver:
     # Notes:
     #######################################################################
     def buildURL (self, type, serverUrl, basePath, year, DOY):
-        urlList = []     # create empty data source list
-
-        # loop through each day in the year and download the TOMS data
-        for doy in range(1, DOY + 1):
-            # get the month/day for the current DOY
-            currday = datetime.datetime(year, 1, 1) + datetime.timedelta(doy-1)
-            datestr = currday.strftime("%Y%m%d")
-
-            # build the filename regular expression for the specified
-            # instrument type, year, and DOY
-            if type == 'NIMBUS':
-                name = 'L3_ozone_n7t_%s.txt' % datestr
-            elif type == 'EARTHPROBE':
-                name = 'L3_ozone_epc_%s.txt' % datestr
-            elif type == 'METEOR3':
-                name = 'L3_ozone_m3t_%s.txt' % datestr
-            elif type == 'OMI':
-                name = 'L3_ozone_omi_%s.txt' % datestr
-            else:
-                logger.warn('Could not categorize datasource for: {0}'
-                            .format(type))
-                return None
+        # get the filename template for the specified instrument type
+        template = FILENAME_TEMPLATES.get(type)
+        if template is None:
+            logger.warn('Could not categorize datasource for: {0}'
+                        .format(type))
+            return None
 
-            # build the URL with the information provided
-            url = serverUrl + basePath + str(year) + '/' + name
-            urlList.append(url)
+        # loop through each day in the year and build the URL of the TOMS
+        # data for that day
+        prefix = serverUrl + basePath + str(year) + '/'
+        urlList = []     # create empty data source list
+        for datestr in dateStrings(year, DOY):
+            urlList.append(prefix + template % datestr)
 
         # return the URL list
         return urlList 
@@ -208,32 +225,6 @@ class DatasourceResolver:
 # End DatasourceResolver class
 ############################################################################
 
-############################################################################
-# Description: isLeapYear will determine if the specified year is a leap
-# year.
-#
-# Inputs:
-#   year - year to determine if it is a leap year (integer)
-#
-# Returns:
-#     True - yes, this is a leap year
-#     False - no, this is not a leap year
-#
-# Notes:
-############################################################################
-def isLeapYear (year):
-    if (year % 4) == 0:
-        if (year % 100) == 0:
-            if (year % 400) == 0:
-                return True
-            else:
-                return False
-        else:
-            return True
-    else:
-        return False
-
-
 ############################################################################
 # Description: cleanTomsTargetDir will regressively clean the TOMS HDF files
 # from the TOMS directory for the specified year.
@@ -251,7 +242,7 @@ def isLeapYear (year):
 def cleanTomsTargetDir (ancdir, year):
     mydir = "%s/EP_TOMS/ozone_%d" % (ancdir, year)
     logger.info('Cleaning TOMS target directory: {0}'.format(mydir))
-    regex = re.compile('TOMS_' + str(year) + '\d*.hdf')
+    regex = re.compile('TOMS_' + str(year) + r'\d+\.hdf')
     if os.path.exists(mydir):
         # look at each file in the specified directory
         for myfile in os.listdir(mydir):
@@ -262,7 +253,7 @@ def cleanTomsTargetDir (ancdir, year):
                 try:
                     os.remove(name)
                     # logger.info('Removed {0}'.format(name))
-                except:
+                except OSError:
                     logger.error('Could not remove {0}'.format(name))
 
 
@@ -319,34 +310,146 @@ def getOzoneSource (filename):
 # Notes:
 ############################################################################
 def resolveFile (fileList):
-    omiregex = re.compile('.*_omi_\d*.txt')
-    earthproberegex = re.compile('.*_epc_\d*.txt')
-    meteor3regex = re.compile('.*_m3t_\d*.txt')
-    nimbusregex = re.compile('.*_n7t_\d*.txt')
-
-    # loop through the files, looping for OMI, EARTHPROBE, METEOR3, and NIMBUS7
-    # files in that order.  return the first one found as the file to be
-    # processed.
+    # files look like L3_ozone_XXX_YYYYMMDD.txt where XXX is the instrument
+    # type.  make a single pass through the files to find the file for each
+    # instrument.
+    found = {}
     for myfile in fileList:
-        if omiregex.search(myfile):
-            return myfile
+        parts = myfile.split('_')
+        if len(parts) >= 4:
+            found[parts[2]] = myfile
 
-    for myfile in fileList:
-        if earthproberegex.search(myfile):
-            return myfile
-
-    for myfile in fileList:
-        if meteor3regex.search(myfile):
-            return myfile
-
-    for myfile in fileList:
-        if nimbusregex.search(myfile):
-            return myfile
+    # return the file for the highest priority instrument found
+    for inst in INSTRUMENT_PRIORITY:
+        if inst in found:
+            return found[inst]
 
     # if none of the files match our known instruments then return None
     return None
 
 
+############################################################################
+# Description: tomsOutputPath generates the name of the processed TOMS HDF
+# file for the specified day.
+#
+# Inputs:
+#   outputDir - name of the directory containing the TOMS HDF files for the
+#               year
+#   year - year of the TOMS data (integer)
+#   doy - DOY of the TOMS data (integer)
+#
+# Returns:
+#   name - full pathname of the TOMS HDF file
+############################################################################
+def tomsOutputPath (outputDir, year, doy):
+    return "%s/TOMS_%d%03d.hdf" % (outputDir, year, doy)
+
+
+############################################################################
+# Description: downloadUrl will retrieve a single file from the TOMS http
+# site and download it to the desired destination.  If there is a problem
+# with the connection, then the download is retried (see SESSION).
+#
+# Inputs:
+#   url - URL of the file to download
+#   destination - name of the directory on the local system to download the
+#                 TOMS file
+#   since - only download the file if it was modified after this time
+#           (seconds since the epoch).  Default is None, which always
+#           downloads the file.
+#
+# Returns:
+#     (status, filename) - status is SUCCESS along with the name of the
+#         downloaded file in the destination directory, UNCHANGED if the
+#         file was not modified after since, or ERROR if the file could not
+#         be downloaded.  filename is None if nothing was downloaded.
+#
+# Notes:
+#   1. Download problems are only logged since the missing days will be
+#      reported when the files are processed.
+#   2. The downloaded file gets the modification time reported by the
+#      server (Last-Modified), like wget does.
+############################################################################
+def downloadUrl (url, destination, since=None):
+    logger.info('Retrieving {0} to {1}'.format(url, destination))
+    myfile = url.split('/')[-1]
+    name = os.path.join(destination, myfile)
+    headers = {}
+    if since is not None:
+        headers['If-Modified-Since'] = email.utils.formatdate(since,
+                                                              usegmt=True)
+    try:
+        with SESSION.get(url, headers=headers, stream=True,
+                         timeout=DOWNLOAD_TIMEOUT) as r:
+            if r.status_code == requests.codes.not_modified:
+                logger.info('{0} has not been modified'.format(url))
+                return (UNCHANGED, None)
+            r.raise_for_status()
+            with open(name, 'wb') as f:
+                for chunk in r.iter_content(65536):
+                    f.write(chunk)
+            lastModified = r.headers.get('Last-Modified')
+
+        # keep the modification time of the file on the server
+        if lastModified:
+            parsed = email.utils.parsedate_tz(lastModified)
+            if parsed is not None:
+                mtime = email.utils.mktime_tz(parsed)
+                os.utime(name, (mtime, mtime))
+    except (requests.RequestException, IOError, OSError) as e:
+        logger.warn('unsuccessful download of {0} ({1})'.format(url, e))
+        # don't leave a partial file behind to be processed
+        try:
+            if os.path.exists(name):
+                os.remove(name)
+        except OSError as e:
+            logger.warn('Could not remove {0} ({1})'.format(name, e))
+        return (ERROR, None)
+
+    return (SUCCESS, myfile)
+
+
+############################################################################
+# Description: downloadDay will retrieve the files for a single day from
+# the TOMS http site, in the order the URLs are listed.
+#
+# Inputs:
+#   day - tuple of (doy, datestr, urlList, destination, since) where urlList
+#         is the list of URLs for the day, destination is the name of the
+#         directory on the local system to download the TOMS files, and
+#         since is the modification time of the existing HDF file for the
+#         day (None if there isn't one)
+#
+# Returns:
+#   (doy, datestr, fileList, uptodate) - the day along with the list of the
+#       files successfully downloaded for that day.  uptodate is True if
+#       the files on the server have not been modified since the existing
+#       HDF file was made, in which case nothing is downloaded.
+############################################################################
+def downloadDay (day):
+    (doy, datestr, urlList, destination, since) = day
+    fileList = []
+    unchanged = []    # URLs not modified since the HDF file was made
+    for url in urlList:
+        (status, myfile) = downloadUrl(url, destination, since)
+        if status == SUCCESS:
+            fileList.append(myfile)
+        elif status == UNCHANGED:
+            unchanged.append(url)
+
+    # if some of the files were modified, then the day will be processed
+    # again and the unchanged files are still needed to determine the
+    # priority file
+    if len(fileList) > 0:
+        for url in unchanged:
+            (status, myfile) = downloadUrl(url, destination)
+            if status == SUCCESS:
+                fileList.append(myfile)
+        unchanged = []
+
+    return (doy, datestr, fileList, len(unchanged) > 0)
+
+
 ############################################################################
 # Description: downloadToms will retrieve the files for the specified year
 # from the TOMS http site and download to the desired destination.  If the
@@ -358,69 +461,132 @@ def resolveFile (fileList):
 #   DOY - download data up through the DOY (integer)
 #   destination - name of the directory on the local system to download the
 #                 TOMS files
+#   pool - thread pool used to run the downloads
+#   outputDir - name of the directory containing the processed TOMS HDF
+#               files for the year
 #
 # Returns:
-#     ERROR - error occurred while processing
-#     SUCCESS - processing completed successfully
+#     None - error occurred while processing
+#     dayList - iterator of (doy, datestr, fileList, uptodate) for each
+#               day, see downloadDay.  each day is returned as soon as its
+#               files are downloaded, in no specific order.
 #
 # Notes:
+#   1. The days are downloaded in parallel on the pool, since each download
+#      spends most of its time waiting on the network.
+#   2. The files for days which already have an HDF file are only
+#      downloaded if they were modified on the server after the HDF file
+#      was made.
 ############################################################################
-def downloadToms (year, DOY, destination):
-    logger = logging.getLogger(__name__)  # Get logger for the module.
+def downloadToms (year, DOY, destination, pool, outputDir):
     # make sure the download directory exists (and is cleaned up) or create
     # it recursively
-    if not os.path.exists(destination):
-        logger.info('{0} does not exist... creating'.format(destination))
+    try:
+        if os.path.exists(destination):
+            # directory already exists and possibly has files in it.  any old
+            # files need to be cleaned up, so start over with an empty
+            # directory
+            logger.info('Cleaning download directory: {0}'
+                        .format(destination))
+            shutil.rmtree(destination)
+        else:
+            logger.info('{0} does not exist... creating'.format(destination))
         os.makedirs(destination, 0777)
-    else:
-        # directory already exists and possibly has files in it.  any old
-        # files need to be cleaned up
-        logger.info('Cleaning download directory: {0}'.format(destination))
-        for myfile in os.listdir(destination):
-            name = os.path.join(destination, myfile)
-            if not os.path.isdir(name):
-                os.remove(name)
+    except OSError as e:
+        logger.error('Could not prepare download directory {0}: {1}'
+                     .format(destination, e))
+        return None
 
     # obtain the list of URL(s) for our particular date, up through the DOY
     urlList = DatasourceResolver().resolve(year, DOY)
     if urlList == None:
         logger.warn('TOMS URL could not be resolved for year {0} up through '
                     'DOY {1}. Processing will continue ...'.format(year, DOY))
-        return ERROR
+        return None
+
+    # group the URLs by the date of their daily file
+    urlsByDate = collections.defaultdict(list)
+    for url in urlList:
+        match = DATE_REGEX.search(url)
+        if match:
+            urlsByDate[match.group(1)].append(url)
 
     # download the data for the current year from the list of URLs.
-    # if there is a problem with the connection, then retry up to 5 times.
-    # Note: if you don't like the wget output, --quiet can be used to minimize
-    # the output info.  wget will return a nonzero value if there was a problem.
     logger.info('Downloading data for year {0} to: {1}'
                 .format(year, destination))
+    dayList = []
+    for (doy, datestr) in enumerate(dateStrings(year, DOY), 1):
+        try:
+            since = os.path.getmtime(tomsOutputPath(outputDir, year, doy))
+        except OSError:
+            since = None
+        dayList.append((doy, datestr, urlsByDate[datestr], destination,
+                        since))
+    return pool.imap_unordered(downloadDay, dayList)
 
-    for url in urlList:
-        logger.info('Retrieving {0} to {1}'.format(url, destination))
-        cmd = 'wget --tries=5 %s' % url 
-        retval = subprocess.call(cmd, shell=True, cwd=destination)
-
-        # make sure the wget was successful or retry up to 5 more times and
-        # sleep in between
-        if retval:
-            retry_count = 1
-            while ((retry_count <= 5) and (retval)):
-                time.sleep(60)
-                logger.info('Retry {0} of wget for {1}'
-                            .format(retry_count, url))
-                retval = subprocess.call(cmd, shell=True, cwd=destination)
-                retry_count += 1
-    
-            if retval:
-                logger.warn('unsuccessful download of {0} (retried 5 times)'
-                            .format(url))
 
-    return SUCCESS
+############################################################################
+# Description: convertOzone processes a single daily ozone text file into
+# the daily HDF file.  If the output file already exists and is newer than
+# the text file, then there is nothing to do.
+#
+# Inputs:
+#   job - tuple of (fullInputPath, fullOutputPath, ozoneSource, year, doy)
+#         for the day to be processed
+#
+# Returns: nothing
+#
+# Notes:
+#   1. Errors are only logged so processing will continue with the other
+#      days.
+#   2. convert_ozone writes to a temporary file, which replaces the output
+#      file only if the conversion succeeds.  A failed or interrupted
+#      conversion therefore never leaves a partial HDF file behind that
+#      would look up to date on the next run.
+############################################################################
+def convertOzone (job):
+    (fullInputPath, fullOutputPath, ozoneSource, year, doy) = job
+    if os.path.isfile(fullOutputPath):
+        if os.path.getmtime(fullOutputPath) >= os.path.getmtime(fullInputPath):
+            logger.info('{0} is up to date'.format(fullOutputPath))
+            return
+    tmpOutputPath = fullOutputPath + '.tmp'
+    cmd = ['convert_ozone', fullInputPath, tmpOutputPath, ozoneSource]
+    logger.info('Executing {0}'.format(' '.join(cmd)))
+    try:
+        # convert_ozone adds to an existing output file, so remove any
+        # temporary file left over from an interrupted run
+        if os.path.exists(tmpOutputPath):
+            os.remove(tmpOutputPath)
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT,
+                                universal_newlines=True)
+        output = proc.communicate()[0].rstrip('\n')
+        exit_code = proc.returncode
+    except OSError as e:
+        output = 'convert_ozone: {0}'.format(e.strerror)
+        exit_code = ERROR
+    logger.info(output)
+
+    # replace the output file with the new one, or discard what was written
+    try:
+        if exit_code == 0:
+            os.rename(tmpOutputPath, fullOutputPath)
+        elif os.path.exists(tmpOutputPath):
+            os.remove(tmpOutputPath)
+    except OSError as e:
+        logger.warn('Could not move {0} to {1} ({2})'
+                    .format(tmpOutputPath, fullOutputPath, e))
+        exit_code = ERROR
+    if exit_code != 0:
+        logger.warn('error running convert_ozone for year'
+                    ' {0}, DOY {1}.  processing will continue ...'
+                    .format(year, doy))
 
 
 ############################################################################
 # Description: getTomsData downloads the daily ozone data files for the
-# desired year, then processes the text files into individual daily HDF
+# desired year, and processes the text files into individual daily HDF
 # files containing the ozone.
 #
 # Inputs:
@@ -433,55 +599,73 @@ def downloadToms (year, DOY, destination):
 #     SUCCESS - processing completed successfully
 #
 # Notes:
+#   1. The downloads and conversions are pipelined.  Each day is converted
+#      as soon as its files are downloaded, while the remaining days are
+#      still being downloaded.
+#   2. Days with an HDF file that is up to date with the files on the
+#      server are skipped.
+#   3. Unexpected errors while downloading or converting one day are
+#      logged, and the other days are still processed.
 ############################################################################
 def getTomsData (ancdir, year):
-    logger = logging.getLogger(__name__)  # Obtain logger for this module.
-
     # if the specified year is the current year, only process up through
     # today otherwise process through all the days in the year
     now = datetime.datetime.now()
     if year == now.year:
         day_of_year = now.timetuple().tm_yday
+    elif calendar.isleap(year):
+        day_of_year = 366
     else:
-        if isLeapYear (year) == True:
-            day_of_year = 366   
-        else:
-            day_of_year = 365
+        day_of_year = 365
 
-    # download the daily ozone files for the specified year to /tmp/ep_toms
+    # download the daily ozone files for the specified year to /tmp/ep_toms.
+    # the days are converted, one conversion per CPU at the same time, as
+    # soon as they have been downloaded.  each day is written to its own
+    # output file.
     dloaddir = "/tmp/ep_toms/%d" % year
-    status = downloadToms (year, day_of_year, dloaddir)
-    if status == ERROR:
-        # warning message already printed
-        return ERROR
-
-    # determine the directory for the output ancillary data files to be
-    # processed.  create the directory if it doesn't exist.
+    downloadPool = ThreadPool(DOWNLOAD_THREADS)
+    convertPool = ThreadPool(multiprocessing.cpu_count())
     outputDir = "%s/EP_TOMS/ozone_%d" % (ancdir, year)
-    if not os.path.exists(outputDir):
-        logger.info('{0} does not exist... creating'.format(outputDir))
-        os.makedirs(outputDir, 0777)
-
-    # loop through each day in the year and process the TOMS data
-    for doy in range(1, day_of_year + 1):
-        # get the month/day for the current DOY
-        currday = datetime.datetime (year, 1, 1) + datetime.timedelta (doy-1)
-        datestr = currday.strftime("%Y%m%d")
-
-        # find all the files for the current day
-        fileList = []    # create empty list to store files matching date
-        for myfile in os.listdir(dloaddir):
-            if fnmatch.fnmatch (myfile, '*' + datestr + ".txt"):
-                fileList.append(myfile)
+    results = []    # results of the conversions that were started
+    try:
+        dayList = downloadToms (year, day_of_year, dloaddir, downloadPool,
+                                outputDir)
+        if dayList is None:
+            # warning message already printed
+            return ERROR
+
+        # make sure the directory for the output ancillary data files to be
+        # processed exists.  create the directory if it doesn't exist.
+        if not os.path.exists(outputDir):
+            logger.info('{0} does not exist... creating'.format(outputDir))
+            os.makedirs(outputDir, 0777)
+
+        # loop through each day as it is downloaded and determine the TOMS
+        # file to be processed.  an unexpected error for one day doesn't stop
+        # the other days.
+        while True:
+            try:
+                (doy, datestr, fileList, uptodate) = next(dayList)
+            except StopIteration:
+                break
+            except Exception as e:
+                logger.warn('error downloading TOMS data for year {0} ({1}).'
+                            ' processing will continue ...'.format(year, e))
+                continue
+
+            if uptodate:
+                logger.info('TOMS data for doy {0} year {1} is up to date'
+                            .format(doy, year))
+                continue
+
+            # make sure files were found or print a warning
+            nfiles = len(fileList)
+            if nfiles == 0:
+                logger.warn('no TOMS data available for doy {0} year'
+                            ' {1} ({2}). processing will continue ...'
+                            .format(doy, year, datestr))
+                continue
 
-        # make sure files were found or print a warning
-        nfiles = len(fileList)
-        if nfiles == 0:
-            logger.warn('no TOMS data available for doy {0} year'
-                        ' {1} ({2}). processing will continue ...'
-                        .format(doy, year, datestr))
-            continue
-        else:
             # if only one file was found which matched our date, then that's
             # the file we'll process.  if more than one was found, then the
             # file needs to be resolved based on instrument type.
@@ -490,8 +674,8 @@ def getTomsData (ancdir, year):
             else:
                 tomsfile = resolveFile (fileList)
                 if tomsfile == None:
-                    logger.warn('error resolving the list of TOMS'
-                                ' files to process. processing will continue ...')
+                    logger.warn('error resolving the list of TOMS files to'
+                                ' process. processing will continue ...')
                     continue
 
             # get the ozone source
@@ -503,28 +687,29 @@ def getTomsData (ancdir, year):
                 continue
 
             # generate the full path for the input and output file to be
-            # processed. if the output file already exists, then remove it.
-            fullOutputPath = "%s/TOMS_%d%03d.hdf" % (outputDir, year, doy)
+            # processed and start the conversion
+            fullOutputPath = tomsOutputPath(outputDir, year, doy)
             fullInputPath = os.path.join(dloaddir, tomsfile)
-            if os.path.isfile(fullOutputPath):
-                os.remove(fullOutputPath)
-            cmdstr = 'convert_ozone %s %s %s' % (fullInputPath, fullOutputPath,
-                ozoneSource)
-            logger.info('Executing {0}'.format(cmdstr))
-            (status, output) = commands.getstatusoutput (cmdstr)
-            logger.info(output)
-            exit_code = status >> 8
-            if exit_code != 0:
-                logger.warn('error running convert_ozone for year'
-                            ' {0}, DOY {1}.  processing will continue ...'
-                            .format(year, doy))
-    # end for doy
-
-    # remove the files downloaded to the temporary directory
+            job = (fullInputPath, fullOutputPath, ozoneSource, year, doy)
+            results.append(convertPool.apply_async(convertOzone, (job,)))
+        # end while
+    finally:
+        # wait for the downloads and conversions to complete
+        for pool in (downloadPool, convertPool):
+            pool.close()
+            pool.join()
+
+    # report any unexpected error from the conversions
+    for result in results:
+        try:
+            result.get()
+        except Exception as e:
+            logger.warn('error converting TOMS data for year {0} ({1}).'
+                        ' processing will continue ...'.format(year, e))
+
+    # remove the temporary directory along with the downloaded files
     logger.info('Removing downloaded files')
-    for myfile in os.listdir(dloaddir):
-        name = os.path.join(dloaddir, myfile)
-        os.remove(name)
+    shutil.rmtree(dloaddir, ignore_errors=True)
 
     return SUCCESS
 
@@ -551,9 +736,10 @@ def getTomsData (ancdir, year):
 # 3. --quarterly will process the data for today all the way back to the
 #    earliest year so that any updated TOMS files are picked up and
 #    processed.
-# 4. Existing TOMS HDF files are removed before processing data for that
+# 4. Existing TOMS HDF files are replaced when processing data for that
 #    year and DOY, but only if the downloaded ancillary data exists for that
-#    date.
+#    date and converts successfully.  Days whose TOMS HDF file is newer than the ancillary data on the
+#    server are not downloaded or processed again.
 ############################################################################
 def main ():
     # get the command line arguments
@@ -565,7 +751,8 @@ def main ():
     parser.add_option ("--today", dest="today", default=False,
         action="store_true",
         help="process TOMS data for the most recent year")
-    msg = "reprocess all TOMS data from today back to %d" % START_YEAR
+    msg = ("reprocess any TOMS data updated on the server from today back "
+           "to %d" % START_YEAR)
     parser.add_option ("--quarterly", dest="quarterly", default=False,
         action="store_true", help=msg)
 
@@ -575,8 +762,6 @@ def main ():
     today = options.today           # process most recent year of data
     quarterly = options.quarterly   # process today back to START_YEAR
 
-    logger = logging.getLogger(__name__)  # Get logger for the module.
-
     # check the arguments
     if (today == False) and (quarterly == False) and \
        (syear == 0 or eyear == 0):